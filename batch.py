@@ -0,0 +1,102 @@
+import sys, json, time, multiprocessing
+from vm import Vm, Script
+
+# the image, read once in the parent before the pool forks so no worker re-reads the file. It is kept
+# as a single string: forked workers only ever touch its one object header, so the bytes stay on pages
+# shared copy-on-write, and each job splits its own private copy into words
+image = ""
+# likewise every snapshot the manifest names: filename -> (position, registers, stack, memory string),
+# or the exception raised loading it, so the jobs that use it can report it
+snapshots = {}
+
+def loadImage(filename):
+	"""reads a binary in one go."""
+	with open(filename, "rb") as f:
+		return f.read()
+
+def loadSnapshot(filename):
+	"""reads a snapshot written by Vm.saveState: its state, plus its memory as read by loadImage."""
+	position, registers, stack = Vm().readState(filename)
+	return position, registers, stack, loadImage(filename + ".mem")
+
+def unpack(data):
+	"""splits a binary into the packed words Memory.load takes."""
+	return [data[i:i + 2] for i in xrange(0, len(data), 2)]
+
+def runJob(job):
+	"""pool worker: runs one manifest entry on a fresh Vm over the shared image and returns its result."""
+	started = time.time()
+	result = {"name": job.get("name", ""), "status": Vm.ERROR, "error": None}
+	vm = Vm()
+	try:
+		if job.get("snapshot"):
+			snapshot = snapshots[job["snapshot"]]
+			if isinstance(snapshot, Exception):
+				raise snapshot
+			position, registers, stack, data = snapshot
+			vm.memory.load(unpack(data))
+			vm.restoreState(position, registers, stack)
+		else:
+			vm.memory.load(unpack(image))
+		lines = job.get("lines")
+		if lines is None and job.get("input"):
+			with open(job["input"], "r") as f:
+				lines = f.read().splitlines()
+		script = Script(vm, lines or [], True)
+		deadline = None
+		if job.get("timeout"):
+			deadline = started + job["timeout"]
+		result["status"] = vm.run(job.get("budget"), deadline)
+		result["error"] = vm.error
+		result["output"] = script.text()
+	except Exception, e:
+		result["error"] = "{0}: {1}".format(type(e).__name__, e)
+		result["output"] = ""
+	result["executed"] = vm.executed
+	result["position"] = vm.position
+	result["registers"] = list(vm.registers)
+	result["stack depth"] = vm.stack.size()
+	result["state hash"] = "{0:08x}".format(vm.stateHash())
+	result["seconds"] = round(time.time() - started, 3)
+	return result
+
+def run(manifest, results, imagefile="challenge.bin", processes=None):
+	"""runs every job in the manifest (one JSON object per line: name, snapshot, input or lines, budget,
+	timeout in seconds) across a pool and writes one JSON result per line, in completion order. Returns the job count."""
+	global image
+	image = loadImage(imagefile)
+	jobs = []
+	with open(manifest, "r") as f:
+		for line in f:
+			if line.strip():
+				jobs.append(json.loads(line))
+	for job in jobs:
+		filename = job.get("snapshot")
+		if filename and filename not in snapshots:
+			try:
+				snapshots[filename] = loadSnapshot(filename)
+			except Exception, e:
+				snapshots[filename] = e
+	pool = multiprocessing.Pool(processes)
+	try:
+		with open(results, "w") as out:
+			for result in pool.imap_unordered(runJob, jobs):
+				out.write(json.dumps(result, sort_keys=True) + "\n")
+				out.flush()
+				sys.stderr.write(">>> {0}: {1} after {2} instructions\n".format(result["name"], result["status"], result["executed"]))
+	finally:
+		pool.close()
+		pool.join()
+	return len(jobs)
+
+# python batch.py <manifest> <results> [image] [processes]
+if __name__ == "__main__":
+	imagefile = "challenge.bin"
+	processes = None
+	if len(sys.argv) > 3:
+		imagefile = sys.argv[3]
+	if len(sys.argv) > 4:
+		processes = int(sys.argv[4])
+	started = time.time()
+	count = run(sys.argv[1], sys.argv[2], imagefile, processes)
+	sys.stderr.write(">>> {0} jobs in {1:.1f}s\n".format(count, time.time() - started))
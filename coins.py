@@ -0,0 +1,121 @@
+import sys, re, itertools, time
+import memscan
+from vm import Vm, Script
+
+numbers = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10}
+shapes = {'triangle': 3, 'square': 4, 'pentagon': 5, 'hexagon': 6, 'heptagon': 7, 'octagon': 8, 'nonagon': 9, 'decagon': 10}
+marking = re.compile(r"has (?:a |an )?(\w+)(?: dots?)? on one side")
+
+class Equation:
+	"""an equation with blanks to fill, like "_ + _ * _^2 + _^3 - _ = 399". Each _ is a slot; numbers
+	are constants.
+
+	>>> Equation("_ + 3 * _ = 11").solve({'a': 2, 'b': 3, 'c': 5})
+	[['a', 'b'], ['c', 'a']]
+	"""
+	pattern = re.compile(r"((?:[_\d]+(?:\^\d+)?\s*[-+*]\s*)+[_\d]+(?:\^\d+)?)\s*=\s*(\d+)")
+	blank = re.compile(r"_")
+
+	def __init__(self, text):
+		match = Equation.pattern.search(text)
+		if match is None:
+			raise ValueError("no equation in " + repr(text))
+		self.text = match.group(0)
+		self.total = int(match.group(2))
+		self.slots = 0
+		expression = Equation.blank.sub(self.slot, match.group(1)).replace("^", "**")
+		# compiled once, so each candidate costs a single call
+		self.evaluate = eval("lambda s: " + expression)
+
+	def slot(self, match):
+		text = "s[" + str(self.slots) + "]"
+		self.slots += 1
+		return text
+
+	def solve(self, values):
+		"""values maps a name to its number; returns the names in slot order for every arrangement that balances."""
+		names = sorted(values)
+		evaluate, total = self.evaluate, self.total
+		solutions = []
+		for order in itertools.permutations(names, self.slots):
+			if evaluate([values[name] for name in order]) == total:
+				solutions.append(list(order))
+		return solutions
+
+def value(description):
+	"""the number marked on an item, going by its description, or None."""
+	match = marking.search(description)
+	if match is None:
+		return None
+	word = match.group(1).lower()
+	return numbers.get(word, shapes.get(word))
+
+class Puzzle:
+	"""an unsolved equation in some room's description, and the items whose markings can fill it."""
+	def __init__(self, w):
+		self.rooms = memscan.rooms(w)
+		self.items = memscan.items(w, self.rooms)
+		self.room = None
+		for address, room in self.rooms.items():
+			if "_" in room.description and Equation.pattern.search(room.description):
+				self.room = address
+				self.equation = Equation(room.description)
+				break
+		if self.room is None:
+			raise ValueError("no unsolved equation found in memory")
+		self.pieces = {}
+		for address, item in self.items.items():
+			marked = value(item.description)
+			if marked is not None and item.location != 32767:
+				self.pieces[item.name] = (address, marked)
+
+	def solve(self):
+		values = dict((name, marked) for name, (address, marked) in self.pieces.items())
+		return self.equation.solve(values)
+
+def apply(vm, puzzle, order):
+	"""hands the pieces to the player in the equation's room of a loaded Vm and uses them in order;
+	returns whether the monument clicked, and the transcript."""
+	w = memscan.words(vm.memory)
+	here = memscan.currentRoom(w, puzzle.rooms)
+	memscan.poke(vm.memory, here, puzzle.room)
+	memscan.poke(vm.memory, here + 1, puzzle.room)
+	for name in order:
+		memscan.poke(vm.memory, puzzle.pieces[name][0] + 2, 0)
+	script = Script(vm, ["use " + name for name in order])
+	vm.running = True
+	vm.run()
+	text = script.text()
+	return "click" in text, text
+
+# python coins.py [snapshot]
+# with no snapshot, challenge.bin is run up to its first prompt so the strings are decrypted
+if __name__ == "__main__":
+	vm = Vm()
+	if len(sys.argv) > 1:
+		vm.loadState(sys.argv[1])
+	else:
+		vm.loadFile("challenge.bin")
+		Script(vm, [])
+		vm.run()
+	started = time.time()
+	try:
+		puzzle = Puzzle(memscan.words(vm.memory))
+	except ValueError, e:
+		print ">>> " + str(e)
+		sys.exit(1)
+	solutions = puzzle.solve()
+	elapsed = time.time() - started
+	print ">>> " + puzzle.equation.text
+	if not solutions:
+		print ">>> No arrangement of " + ", ".join(sorted(puzzle.pieces)) + " balances."
+		sys.exit(1)
+	order = solutions[0]
+	print ">>> " + " ".join(str(puzzle.pieces[name][1]) for name in order) + " (" + str(int(elapsed * 1000)) + " ms): " + ", ".join(order)
+	ok, text = apply(vm, puzzle, order)
+	if ok:
+		print ">>> Verified: the monument clicks."
+	else:
+		print ">>> Verification failed, transcript follows."
+		print text
+		sys.exit(1)
@@ -1,4 +1,4 @@
-import sys, struct
+import sys, struct, binascii, cPickle, multiprocessing
 
 class Memory:
 	def __init__(self):
@@ -21,29 +21,16 @@ class Memory:
 
 class Vm:
 	codes = ['halt', 'set', 'push', 'pop', 'eq', 'gt', 'jmp', 'jt', 'jf', 'add', 'mult', 'mod', 'and', 'or', 'not', 'rmem', 'wmem', 'call', 'ret', 'out', 'in', 'noop']
+	arity = [0, 2, 1, 1, 3, 3, 1, 2, 2, 3, 3, 3, 3, 3, 2, 2, 2, 1, 0, 1, 1, 0]
 
 	def __init__(self):
 		self.memory = Memory()
 		self.position = 5900
 		self.running = True
 		self.unpacker = struct.Struct('<H')
-
-	def loadFile(self, filename):
-		dump = []
-		for word in self.readFile(filename):
-			dump.append(word)
-		self.memory.load(dump)
-	def readFile(self, filename):
-		with open(filename, "rb") as f:
-			while True:
-				word = f.read(2)
-				if word:
-					yield word
-				else:
-					break
-
-	def run(self, start, numcodes):
-		dispatch = {
+		self.index = {}
+		self.fresh = {}
+		self.dispatch = {
 			'halt': self.opcodeHalt,
 			'set': self.opcodeSet,
 			'push': self.opcodePush,
@@ -68,6 +55,26 @@ class Vm:
 			'noop': self.opcodeNoop
 		}
 
+	def loadFile(self, filename):
+		dump = []
+		for word in self.readFile(filename):
+			dump.append(word)
+		self.memory.load(dump)
+	def readFile(self, filename):
+		with open(filename, "rb") as f:
+			while True:
+				word = f.read(2)
+				if word:
+					yield word
+				else:
+					break
+
+	def run(self, start, numcodes):
+		for line in self.listing(start, numcodes):
+			print line
+
+	def listing(self, start, numcodes):
+		"""yields one line of disassembly per instruction, starting at start, for numcodes + 1 instructions."""
 		if start != "":
 			self.position = int(start)
 
@@ -78,14 +85,39 @@ class Vm:
 
 		i = 0
 
-		while self.running and i <= numcodes:
-			instruction = self.memory.at(self.position)
-			try:
-				code = Vm.codes[self.u(instruction)]
-				print str(self.position) + " (" + str(hex(self.position * 2)) + "): " + dispatch[code]()
+		while self.running and i <= numcodes and self.position < self.memory.size():
+			position = self.position
+			text = self.decode()
+			if text is not None:
+				yield str(position) + " (" + str(hex(position * 2)) + "): " + text
 				i += 1
+
+	def key(self, position):
+		"""index key for the instruction at position: its address plus the hex of every word it occupies."""
+		words = self.memory.store[position:position + 1]
+		if words:
+			op = self.u(words[0])
+			if op < len(Vm.arity):
+				words = self.memory.store[position:position + 1 + Vm.arity[op]]
+		return str(position) + ":" + binascii.hexlify(''.join(words))
+
+	def decode(self):
+		"""disassembles the instruction at self.position and moves past it, returning None if it doesn't decode.
+
+		results are kept in self.index (and new ones in self.fresh) so an identical instruction at the same address is never decoded twice."""
+		position = self.position
+		key = self.key(position)
+		if key not in self.index:
+			try:
+				code = Vm.codes[self.u(self.memory.at(position))]
+				text = self.dispatch[code]()
 			except Exception, e:
 				self.advance()
+				text = None
+			self.index[key] = self.fresh[key] = (text, self.position - position)
+		text, size = self.index[key]
+		self.position = position + size
+		return text
 
 	def u(self, data):
 		"""unpacks the data using self.unpacker"""
@@ -338,8 +370,55 @@ class Vm:
 		self.advance()
 		return r"NOOP"
 
-vm = Vm()
+indexfile = "decompiler.idx"
+sharedIndex = {}
 
-vm.loadFile("001.mem")
-
-vm.run(sys.argv[1], sys.argv[2])
\ No newline at end of file
+def loadIndex(filename):
+	try:
+		with open(filename, "rb") as f:
+			return cPickle.load(f)
+	except IOError, e:
+		return {}
+
+def saveIndex(filename, index):
+	with open(filename, "wb") as f:
+		cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+
+def disassembleImage(job):
+	"""pool worker: disassembles one image against this worker's copy of the index."""
+	filename, start, numcodes = job
+	vm = Vm()
+	vm.index = sharedIndex
+	vm.loadFile(filename)
+	lines = list(vm.listing(start, numcodes))
+	return filename, lines, vm.fresh
+
+def batch(start, numcodes, filenames):
+	"""disassembles every image in a process pool, printing each listing as it arrives and growing the on-disk index."""
+	sharedIndex.update(loadIndex(indexfile))
+	known = len(sharedIndex)
+	pool = multiprocessing.Pool()
+	try:
+		for filename, lines, fresh in pool.imap(disassembleImage, [(filename, start, numcodes) for filename in filenames]):
+			print "== " + filename + " (" + str(len(fresh)) + " newly decoded) =="
+			for line in lines:
+				print line
+			sys.stdout.flush()
+			sharedIndex.update(fresh)
+	finally:
+		pool.close()
+		pool.join()
+	saveIndex(indexfile, sharedIndex)
+	sys.stderr.write(str(len(sharedIndex) - known) + " instructions added to " + indexfile + "\n")
+
+# python decompiler.py <start> <numcodes>
+# python decompiler.py batch <start> <numcodes> <image> [<image> ...]
+if __name__ == "__main__":
+	if sys.argv[1] == "batch":
+		batch(sys.argv[2], sys.argv[3], sys.argv[4:])
+	else:
+		vm = Vm()
+
+		vm.loadFile("001.mem")
+
+		vm.run(sys.argv[1], sys.argv[2])
\ No newline at end of file
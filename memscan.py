@@ -0,0 +1,94 @@
+import struct
+
+class Room:
+	def __init__(self, address, name, description, exits, callback):
+		self.address = address
+		self.name = name
+		self.description = description
+		self.exits = exits # direction -> address of the neighbouring room
+		self.callback = callback
+
+def words(memory):
+	"""unpacks a Memory (or any list of packed words) into a tuple of ints."""
+	store = memory
+	if hasattr(memory, 'dump'):
+		store = memory.dump()
+	return struct.unpack('<{0}H'.format(len(store)), ''.join(store))
+
+def poke(memory, address, value):
+	"""writes a plain int into a Memory as a packed word."""
+	memory.write(address, struct.pack('<H', value))
+
+def string(w, address, maxlength=4096):
+	"""returns the length-prefixed string at address, or None if there isn't a printable one there."""
+	if address >= len(w):
+		return None
+	length = w[address]
+	if length == 0 or length > maxlength or address + length >= len(w):
+		return None
+	chars = w[address + 1:address + 1 + length]
+	for c in chars:
+		if c != 10 and (c < 32 or c > 126):
+			return None
+	return ''.join(map(chr, chars))
+
+def array(w, address):
+	"""returns the length-prefixed list of words at address."""
+	return list(w[address + 1:address + 1 + w[address]])
+
+def rooms(w):
+	"""finds every room record: five words pointing at a name, a description, a list of exit names,
+	a matching list of destination rooms, and a callback."""
+	found = {}
+	for address in xrange(len(w) - 5):
+		name = string(w, w[address], 64)
+		if name is None:
+			continue
+		description = string(w, w[address + 1])
+		if description is None:
+			continue
+		names, targets = w[address + 2], w[address + 3]
+		if names >= len(w) or targets >= len(w) or w[names] == 0 or w[names] > 16 or w[names] != w[targets]:
+			continue
+		directions = [string(w, a, 64) for a in array(w, names)]
+		if None in directions:
+			continue
+		found[address] = Room(address, name, description, dict(zip(directions, array(w, targets))), w[address + 4])
+	return found
+
+def currentRoom(w, found):
+	"""finds the cell holding the player's current room: the first pair of adjacent cells that both point
+	at rooms (current and previous) and aren't part of a room's list of exits."""
+	exitlists = set()
+	for room in found.values():
+		targets = w[room.address + 3]
+		exitlists.update(xrange(targets, targets + 1 + w[targets]))
+	for address in xrange(len(w) - 1):
+		if w[address] in found and w[address + 1] in found and address not in exitlists:
+			return address
+	return None
+
+class Item:
+	def __init__(self, address, name, description, location, callback):
+		self.address = address
+		self.name = name
+		self.description = description
+		self.location = location # room address, 0 when carried, 32767 when gone
+		self.callback = callback
+
+def items(w, found):
+	"""finds every item record: four words pointing at a name and a description, then the item's location
+	(a room from found, 0 or 32767) and a callback."""
+	inventory = {}
+	for address in xrange(len(w) - 4):
+		location = w[address + 2]
+		if location not in found and location != 0 and location != 32767:
+			continue
+		name = string(w, w[address], 64)
+		if name is None:
+			continue
+		description = string(w, w[address + 1])
+		if description is None:
+			continue
+		inventory[address] = Item(address, name, description, location, w[address + 3])
+	return inventory
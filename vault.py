@@ -0,0 +1,122 @@
+import sys, re, time
+from collections import deque
+import memscan
+from vm import Vm, Script
+
+mosaic = re.compile(r"mosaic depicting (?:the number '(\d+)'|a '([-+*])' symbol)")
+pedestal = re.compile(r"number '(\d+)' is carved into the orb's pedestal")
+door = re.compile(r"large '(\d+)' carved into it")
+
+operators = {
+	'+': lambda a, b: a + b,
+	'-': lambda a, b: a - b,
+	'*': lambda a, b: a * b,
+}
+
+class Vault:
+	"""the orb puzzle as laid out in memory: a tile (number or operator) per room, the weight the orb
+	starts at in the antechamber, and the weight the vault door wants."""
+	def __init__(self, w):
+		self.rooms = memscan.rooms(w)
+		self.tiles = {}
+		self.start = None
+		self.door = None
+		for address, room in self.rooms.items():
+			match = pedestal.search(room.description)
+			if match:
+				self.start = address
+				self.weight = int(match.group(1))
+				self.tiles[address] = self.weight
+				continue
+			match = mosaic.search(room.description)
+			if match:
+				if match.group(1) is not None:
+					self.tiles[address] = int(match.group(1))
+				else:
+					self.tiles[address] = match.group(2)
+			match = door.search(room.description)
+			if match:
+				self.door = address
+				self.target = int(match.group(1))
+		if self.start is None or self.door is None:
+			raise ValueError("no orb vault found in memory")
+
+	def solve(self):
+		"""breadth-first search over (room, weight, pending operator); returns the shortest list of
+		directions that carries the orb from the antechamber to the door at exactly the target weight."""
+		first = (self.start, self.weight, None)
+		parents = {first: None}
+		queue = deque([first])
+		while queue:
+			state = queue.popleft()
+			room, weight, pending = state
+			for direction, neighbour in self.rooms[room].exits.items():
+				# stepping back into the antechamber resets the orb, and off the grid is no use
+				if neighbour == self.start or neighbour not in self.tiles:
+					continue
+				tile = self.tiles[neighbour]
+				if tile in operators:
+					following = (neighbour, weight, tile)
+				else:
+					following = (neighbour, operators[pending](weight, tile), None)
+					# the orb shatters outside 15 bits
+					if following[1] <= 0 or following[1] >= 32768:
+						continue
+				if following in parents:
+					continue
+				parents[following] = (state, direction)
+				if neighbour == self.door:
+					if following[1] == self.target:
+						return self.path(parents, following)
+					# the orb evaporates at the door, so there's nowhere to go from here
+					continue
+				queue.append(following)
+		return None
+
+	def path(self, parents, state):
+		directions = []
+		while parents[state] is not None:
+			state, direction = parents[state]
+			directions.append(direction)
+		directions.reverse()
+		return directions
+
+def verify(vm, vault, directions):
+	"""puts the player in the antechamber of a loaded Vm, walks the path with the orb, and returns
+	whether the vault door flashed white along with the transcript."""
+	w = memscan.words(vm.memory)
+	here = memscan.currentRoom(w, vault.rooms)
+	memscan.poke(vm.memory, here, vault.start)
+	memscan.poke(vm.memory, here + 1, vault.start)
+	script = Script(vm, ["take orb"] + directions)
+	vm.running = True
+	vm.run()
+	text = script.text()
+	return "flashes white" in text, text
+
+# python vault.py [snapshot]
+if __name__ == "__main__":
+	snapshot = "001"
+	if len(sys.argv) > 1:
+		snapshot = sys.argv[1]
+	vm = Vm()
+	vm.loadState(snapshot)
+	started = time.time()
+	try:
+		vault = Vault(memscan.words(vm.memory))
+	except ValueError, e:
+		print ">>> " + str(e)
+		sys.exit(1)
+	directions = vault.solve()
+	elapsed = time.time() - started
+	if directions is None:
+		print ">>> No path to " + str(vault.target) + " found."
+		sys.exit(1)
+	print ">>> " + str(len(directions)) + " moves (" + str(int(elapsed * 1000)) + " ms): " + ", ".join(directions)
+	ok, text = verify(vm, vault, directions)
+	if ok:
+		print ">>> Verified: the vault door flashes white."
+	else:
+		print ">>> Verification failed, transcript follows."
+		print text
+		sys.exit(1)
@@ -1,4 +1,5 @@
-import sys, struct, logging
+import sys, struct, logging, zlib, time, math, threading, BaseHTTPServer
+from array import array
 global bump
 
 class Memory:
@@ -20,33 +21,148 @@ class Memory:
 	def dump(self):
 		return self.store
 
-class Register:
-	global bump
-	def __init__(self, initial_value, register_index, vm):
-		self.value = initial_value
-		self.index = register_index #for debugging purposes
-		self.vm = vm
+	# instruction fetches go through here so TracedMemory can tell them apart from reads
+	fetch = at
+
+class TracedMemory(Memory):
+	"""Memory that counts reads, writes and instruction fetches per address, and the number of distinct
+	addresses touched in each window of fetches. Swapped in only while tracing, so plain Memory pays nothing."""
+	def __init__(self, window=100000, size=32768):
+		Memory.__init__(self)
+		self.window = window
+		self.addresses = size
+		self.reset()
+
+	def reset(self):
+		self.reads = array('L', [0]) * self.addresses
+		self.writes = array('L', [0]) * self.addresses
+		self.executes = array('L', [0]) * self.addresses
+		self.touched = set()
+		self.fetches = 0
+		self.workingSet = []
 
-	def set(self, value):
-		bump.debug(r":{0} <-- {1}".format(self.index, self.vm.u(value)))
-		self.value = value
+	def at(self, memloc):
+		self.reads[memloc] += 1
+		self.touched.add(memloc)
+		return self.store[memloc]
 
-	def get(self):
-		return self.value
+	def write(self, memloc, data):
+		self.writes[memloc] += 1
+		self.touched.add(memloc)
+		self.store[memloc] = data
+
+	def fetch(self, memloc):
+		self.executes[memloc] += 1
+		self.touched.add(memloc)
+		self.fetches += 1
+		if self.fetches % self.window == 0:
+			self.workingSet.append(len(self.touched))
+			self.touched = set()
+		return self.store[memloc]
+
+	def saveCsv(self, filename):
+		"""address,reads,writes,executes for every address touched at least once."""
+		f = open(filename, 'w')
+		f.write("address,reads,writes,executes\n")
+		for memloc in xrange(self.addresses):
+			if self.reads[memloc] or self.writes[memloc] or self.executes[memloc]:
+				f.write("{0},{1},{2},{3}\n".format(memloc, self.reads[memloc], self.writes[memloc], self.executes[memloc]))
+		f.close()
+
+	def saveWorkingSet(self, filename):
+		f = open(filename, 'w')
+		f.write("window,fetches,addresses\n")
+		for i, size in enumerate(self.workingSet + [len(self.touched)]):
+			f.write("{0},{1},{2}\n".format(i, min((i + 1) * self.window, self.fetches), size))
+		f.close()
+
+	def savePgm(self, filename, counters, width=256):
+		"""writes counters as a greyscale PGM image, one pixel per address (row-major, width addresses per
+		row), log-scaled so that hot spots don't wash everything else out."""
+		top = math.log(max(counters) + 1) or 1
+		f = open(filename, 'wb')
+		f.write("P5\n{0} {1}\n255\n".format(width, self.addresses // width))
+		f.write(array('B', [int(255 * math.log(count + 1) / top) for count in counters]).tostring())
+		f.close()
+
+	def snapshot(self, name):
+		"""writes name.csv, name-workingset.csv and a PGM heatmap per counter; returns the filenames."""
+		filenames = [name + ".csv", name + "-workingset.csv"]
+		self.saveCsv(filenames[0])
+		self.saveWorkingSet(filenames[1])
+		for kind in ["reads", "writes", "executes"]:
+			filenames.append(name + "-" + kind + ".pgm")
+			self.savePgm(filenames[-1], getattr(self, kind))
+		return filenames
+
+class StackError(Exception):
+	pass
+
+class Stack:
+	def __init__(self, maxDepth=None):
+		self.store = array('H')
+		self.maxDepth = maxDepth
+		self.highWater = 0
+		self.pushes = 0
+		self.pops = 0
+
+	def push(self, value):
+		depth = len(self.store)
+		if self.maxDepth is not None and depth >= self.maxDepth:
+			raise StackError("stack overflow: depth {0} reached the limit of {1}".format(depth, self.maxDepth))
+		self.store.append(value)
+		self.pushes += 1
+		if depth >= self.highWater:
+			self.highWater = depth + 1
+
+	def pop(self):
+		if not self.store:
+			raise StackError("pop from empty stack")
+		self.pops += 1
+		return self.store.pop()
+
+	def size(self):
+		return len(self.store)
+
+	def load(self, dump):
+		self.store = array('H', dump)
+		self.highWater = max(self.highWater, len(self.store))
+
+	def dump(self):
+		return self.store
+
+	def bytes(self):
+		"""what the stack's array really occupies, header and over-allocated slack included."""
+		return sys.getsizeof(self.store)
 
 class Vm:
 	codes = ['halt', 'set', 'push', 'pop', 'eq', 'gt', 'jmp', 'jt', 'jf', 'add', 'mult', 'mod', 'and', 'or', 'not', 'rmem', 'wmem', 'call', 'ret', 'out', 'in', 'noop']
+	# what run() returns
+	HALTED = "halted"
+	WAITING = "waiting for input"
+	EXHAUSTED = "budget exhausted"
+	ERROR = "error"
+	# instructions run between checks of the instruction budget and deadline
+	chunk = 1024
 	global bump
 
-	def __init__(self):
+	def __init__(self, maxStackDepth=None):
 		self.memory = Memory()
-		self.registers = []
-		self.stack = []
+		self.registers = [0] * 8
+		self.stack = Stack(maxStackDepth)
 		self.position = 0
 		self.running = True
 		self.unpacker = struct.Struct('<H')
-		for i in range(8):
-			self.registers.append(Register(self.p(0), i, self))
+		self.input = sys.stdin
+		self.output = sys.stdout
+		self.executed = 0
+		self.memoryWrites = 0
+		self.outputBytes = 0
+		self.metrics = None
+		# what Metrics measures rates and uptime from
+		self.started = time.time()
+		self.waiting = False
+		self.error = None
 
 	def loadFile(self, filename):
 		dump = []
@@ -62,7 +178,47 @@ class Vm:
 				else:
 					break
 
-	def run(self):
+	def saveState(self, filename):
+		"""writes position, registers and stack to filename and memory to filename.mem."""
+		memfilename = filename + ".mem"
+		f = open(filename, 'w')
+		f2 = open(memfilename, 'w')
+		f.write(str(self.position) + "\n")
+		for reg in self.registers:
+			f.write(str(reg) + "\n")
+		for i in self.stack.dump():
+			f.write(str(i) + "\n");
+		for m in self.memory.dump():
+			f2.write(m)
+		f.close()
+		f2.close()
+	def loadState(self, filename):
+		"""restores a snapshot written by saveState."""
+		self.restoreState(*self.readState(filename))
+		self.loadFile(filename + ".mem")
+	def readState(self, filename):
+		"""reads the position, registers and stack of a snapshot written by saveState, but not its memory."""
+		f = open(filename, 'r')
+		position_str = f.readline()
+		position = int(position_str)
+		registers = []
+		for reg_n in xrange(0,8):
+			registers.append(int(f.readline()))
+		stack = [int(line) for line in f]
+		f.close()
+		return position, registers, stack
+	def restoreState(self, position, registers, stack):
+		self.position = position
+		for reg_n in xrange(0,8):
+			self.registers[reg_n] = registers[reg_n]
+		self.stack.load(stack)
+
+	def run(self, max_instructions=None, deadline=None):
+		"""runs until the program halts, stops to wait for input, hits an error, or uses up max_instructions
+		or the deadline (a time.time() value); returns Vm.HALTED, Vm.WAITING, Vm.ERROR or Vm.EXHAUSTED.
+		the budget is only checked every Vm.chunk instructions, and calling run() again carries on exactly
+		where it stopped. after Vm.ERROR, position is left on the faulting instruction and run() keeps
+		returning Vm.ERROR; setting running back to True clears the error and retries that instruction."""
 		dispatch = {
 			'halt': self.opcodeHalt,
 			'set': self.opcodeSet,
@@ -88,11 +244,56 @@ class Vm:
 			'noop': self.opcodeNoop
 		}
 
-		while self.running:
-			instruction = self.memory.at(self.position)
-			code = Vm.codes[self.u(instruction)]
-			dispatch[code]()
+		end = None
+		if max_instructions is not None:
+			end = self.executed + max_instructions
+		if self.error is not None:
+			if not self.running:
+				# stopped by an error and not restarted: keep reporting it
+				return Vm.ERROR
+			self.error = None
 
+		while self.running:
+			steps = Vm.chunk
+			if end is not None:
+				steps = min(steps, end - self.executed)
+				if steps <= 0:
+					return Vm.EXHAUSTED
+			if deadline is not None and time.time() >= deadline:
+				return Vm.EXHAUSTED
+			done = 0
+			initial = self.position
+			try:
+				for done in xrange(1, steps + 1):
+					initial = self.position
+					instruction = self.memory.fetch(initial)
+					dispatch[Vm.codes[self.u(instruction)]]()
+					if not self.running:
+						break
+			except Exception, e:
+				# the faulting instruction didn't complete, so it isn't counted and position goes back to it
+				done -= 1
+				self.position = initial
+				self.error = "{0} at {1}".format(e, initial)
+				bump.debug("{0}: {1}".format(initial, e))
+				self.running = False
+			self.executed += done
+
+		if self.error is not None:
+			return Vm.ERROR
+		if self.waiting:
+			# opcodeIn left position on the in instruction, so resuming runs it again; it doesn't count yet
+			self.executed -= 1
+			self.waiting = False
+			self.running = True
+			return Vm.WAITING
+		return Vm.HALTED
+
+	def stateHash(self):
+		"""crc32 over position, registers, stack and memory, for checking recorded sessions."""
+		state = zlib.crc32(struct.pack('<9H', self.position, *self.registers))
+		state = zlib.crc32(self.stack.dump().tostring(), state)
+		return zlib.crc32(''.join(self.memory.dump()), state) & 0xffffffff
 	def u(self, data):
 		"""unpacks the data using self.unpacker"""
 		return self.unpacker.unpack(data)[0]
@@ -103,14 +304,12 @@ class Vm:
 		"""advances the memory register by increment."""
 		self.position += increment
 	def resolve(self, data):
-		"""return data if data is a literal value, return register contents if data is a register address."""
+		"""return the value of data as an int: the literal itself, or the register contents if data is a register address."""
 		unpacked = self.u(data)
 		if(unpacked < 32768):
-			return data
+			return unpacked
 		else:
-			register_index = unpacked - 32768
-			data = self.registers[register_index].get()
-			return data
+			return self.registers[unpacked - 32768]
 	def debugresolve(self, data):
 		"""return string representation of data if literal, return strrep of register index if register address."""
 		unpacked = self.u(data)
@@ -118,8 +317,7 @@ class Vm:
 			return str(unpacked)
 		else:
 			register_index = unpacked - 32768
-			data = self.registers[register_index].get()
-			return ":" + str(register_index) + "(" + str(self.u(data)) + ")"
+			return ":" + str(register_index) + "(" + str(self.registers[register_index]) + ")"
 	def opcodeHalt(self):
 		"""stop execution and terminate the program. syntax: 0"""
 		bump.debug("{0}: HALT".format(self.position))
@@ -131,9 +329,12 @@ class Vm:
 		a = self.memory.at(self.position)
 		register_index = self.u(a) - 32768
 		self.advance()
-		b = self.resolve(self.memory.at(self.position))
-		bump.debug("{0}: SET :{1} {2}".format(initial, register_index, self.debugresolve(b)))
-		self.registers[register_index].set(b)
+		b_at = self.memory.at(self.position)
+		b = self.resolve(b_at)
+		bump.debug("{0}: SET :{1} {2}".format(initial, register_index, self.debugresolve(b_at)))
+		self.registers[register_index] = b
+		if(bump.debugFlag):
+			bump.register(register_index, b)
 		self.advance()
 	def opcodePush(self):
 		"""push <a> onto the stack. syntax: 2 a"""
@@ -143,8 +344,8 @@ class Vm:
 		a = self.resolve(at)
 		self.advance()
 		bump.debug("{0}: PUSH {1}".format(initial, self.debugresolve(at)))
-		self.stack.append(a)
-		bump.debug("{0} elements in stack.".format(len(self.stack)))
+		self.stack.push(a)
+		bump.debug("{0} elements in stack.".format(self.stack.size()))
 	def opcodePop(self):
 		"""remove the top element from the stack and write it into <a>; empty stack = error. syntax: 3 a"""
 		initial = self.position
@@ -153,11 +354,13 @@ class Vm:
 		register_index = self.u(a) - 32768
 		self.advance()
 
-		data = self.stack.pop()
+		value = self.stack.pop()
 
-		bump.debug("{0}: POP :{1} ({2})".format(initial, register_index, self.u(data)))
-		self.registers[register_index].set(data)
-		bump.debug("{0} elements in stack.".format(len(self.stack)))
+		bump.debug("{0}: POP :{1} ({2})".format(initial, register_index, value))
+		self.registers[register_index] = value
+		if(bump.debugFlag):
+			bump.register(register_index, value)
+		bump.debug("{0} elements in stack.".format(self.stack.size()))
 	def opcodeEq(self):
 		"""set <a> to 1 if <b> is equal to <c>; set it to 0 otherwise. syntax: 4 a b c"""
 		initial = self.position
@@ -178,9 +381,12 @@ class Vm:
 		bump.debug("{0}: EQ :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
 		if(b == c):
-			self.registers[register_index].set(self.p(1))
+			value = 1
 		else:
-			self.registers[register_index].set(self.p(0))
+			value = 0
+		self.registers[register_index] = value
+		if(bump.debugFlag):
+			bump.register(register_index, value)
 	def opcodeGt(self):
 		"""set <a> to 1 if <b> is greater than <c>; set it to 0 otherwise. syntax: 5 a b c"""
 		initial = self.position
@@ -200,17 +406,21 @@ class Vm:
 
 		bump.debug("{0}: GT :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		if(self.u(b) > self.u(c)):
-			self.registers[register_index].set(self.p(1))
+		if(b > c):
+			value = 1
 		else:
-			self.registers[register_index].set(self.p(0))
+			value = 0
+		self.registers[register_index] = value
+		if(bump.debugFlag):
+			bump.register(register_index, value)
 	def opcodeJmp(self):
 		"""jump to memory location <a>. syntax: 6 a"""
 		initial = self.position
 		self.advance()
-		a = self.resolve(self.memory.at(self.position))
-		bump.debug("{0}: JMP {1}".format(initial, self.debugresolve(a)))
-		self.position = self.u(a)
+		a_at = self.memory.at(self.position)
+		a = self.resolve(a_at)
+		bump.debug("{0}: JMP {1}".format(initial, self.debugresolve(a_at)))
+		self.position = a
 	def opcodeJt(self):
 		"""if <a> is nonzero, jump to <b>. syntax: 7 a b"""
 		initial = self.position
@@ -221,8 +431,8 @@ class Vm:
 		b_at = self.memory.at(self.position)
 		b = self.resolve(b_at)
 		bump.debug("{0}: JT {1} {2}".format(initial, self.debugresolve(a_at), self.debugresolve(b_at)))
-		if(self.u(a) != 0):
-			self.position = self.u(b)
+		if(a != 0):
+			self.position = b
 		else:
 			self.advance()
 	def opcodeJf(self):
@@ -235,8 +445,8 @@ class Vm:
 		b_at = self.memory.at(self.position)
 		b = self.resolve(b_at)
 		bump.debug("{0}: JF {1} {2}".format(initial, self.debugresolve(a_at), self.debugresolve(b_at)))
-		if(self.u(a) == 0):
-			self.position = self.u(b)
+		if(a == 0):
+			self.position = b
 		else:
 			self.advance()
 	def opcodeAdd(self):
@@ -255,11 +465,11 @@ class Vm:
 
 		bump.debug("{0}: ADD :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		int_b = self.u(b)
-		int_c = self.u(c)
-		result = (int_b + int_c) % 32768
+		result = (b + c) % 32768
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeMult(self):
 		"""store into <a> the product of <b> and <c> (modulo 32768). syntax: 10 a b c"""
 		initial = self.position
@@ -276,11 +486,11 @@ class Vm:
 
 		bump.debug("{0}: MULT :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		int_b = self.u(b)
-		int_c = self.u(c)
-		result = (int_b * int_c) % 32768
+		result = (b * c) % 32768
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeMod(self):
 		"""store into <a> the remainder of <b> divided by <c>. syntax: 11 a b c"""
 		initial = self.position
@@ -297,11 +507,11 @@ class Vm:
 
 		bump.debug("{0}: MOD :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		int_b = self.u(b)
-		int_c = self.u(c)
-		result = int_b % int_c
+		result = b % c
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeAnd(self):
 		"""stores into <a> the bitwise and of <b> and <c>. syntax: 12 a b c"""
 		initial = self.position
@@ -318,11 +528,11 @@ class Vm:
 
 		bump.debug("{0}: AND :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		int_b = self.u(b)
-		int_c = self.u(c)
-		result = int_b & int_c
+		result = b & c
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeOr(self):
 		"""stores into <a> the bitwise or of <b> and <c>. syntax: 13 a b c"""
 		initial = self.position
@@ -339,11 +549,11 @@ class Vm:
 
 		bump.debug("{0}: OR :{1} {2} {3}".format(initial, register_index, self.debugresolve(b_at), self.debugresolve(c_at)))
 
-		int_b = self.u(b)
-		int_c = self.u(c)
-		result = int_b | int_c
+		result = b | c
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeNot(self):
 		"""stores 15-bit bitwise inverse of <b> in <a>. syntax: 14 a b"""
 		initial = self.position
@@ -357,9 +567,11 @@ class Vm:
 
 		bump.debug("{0}: NOT :{1} {2}".format(initial, register_index, self.debugresolve(b_at)))
 
-		result = (~(self.u(b)) & ((1 << 15) - 1))
+		result = (~b & ((1 << 15) - 1))
 
-		self.registers[register_index].set(self.p(result))
+		self.registers[register_index] = result
+		if(bump.debugFlag):
+			bump.register(register_index, result)
 	def opcodeRmem(self):
 		"""read memory at address <b> and write it to <a>. syntax: 15 a b"""
 		initial = self.position
@@ -370,11 +582,13 @@ class Vm:
 		b_at = self.memory.at(self.position)
 		b = self.resolve(b_at)
 		#b contains the address which we need to read
-		readdata = self.resolve(self.memory.at(self.u(b)))
+		value = self.resolve(self.memory.at(b))
 		self.advance()
 
 		bump.debug("{0}: RMEM :{1} {2}".format(initial, register_index, self.debugresolve(b_at)))
-		self.registers[register_index].set(readdata)
+		self.registers[register_index] = value
+		if(bump.debugFlag):
+			bump.register(register_index, value)
 	def opcodeWmem(self):
 		"""write the value from <b> into memory at address <a>. syntax: 16 a b"""
 		initial = self.position
@@ -389,7 +603,8 @@ class Vm:
 		self.advance()
 
 		bump.debug("{0}: WMEM {1} {2}".format(initial, self.debugresolve(a_at), self.debugresolve(b_at)))
-		self.memory.write(self.u(a),b)
+		self.memory.write(a, self.p(b))
+		self.memoryWrites += 1
 	def opcodeCall(self):
 		"""write the address of the next instruction to the stack and jump to <a>. syntax: 17 a"""
 		initial = self.position
@@ -400,27 +615,39 @@ class Vm:
 		return_address = self.position
 
 		bump.debug("{0}: CALL {1} (writing next instruction address ({2}) to stack)".format(initial, self.debugresolve(a_at), return_address))
-		self.stack.append(self.p(return_address))
-		self.position = self.u(a)
+		self.stack.push(return_address)
+		self.position = a
 	def opcodeRet(self):
 		"""remove the top element from the stack and jump to it; empty stack = halt. syntax: 18"""
+		if not self.stack.size():
+			bump.debug("{0}: RET (empty stack, halting)".format(self.position))
+			self.running = False
+			return
 		return_address = self.stack.pop()
-		bump.debug("{0}: RET (returning to {1})".format(self.position, self.u(return_address)))
-		self.position = self.u(return_address)
+		bump.debug("{0}: RET (returning to {1})".format(self.position, return_address))
+		self.position = return_address
 	def opcodeOut(self):
 		"""write the character represented by ascii code <a> to the terminal. syntax: 19 a"""
 		initial = self.position
 		self.advance()
 		a = self.resolve(self.memory.at(self.position))
-		char = a.decode(encoding="ASCII")
+		char = self.p(a).decode(encoding="ASCII")
 		bump.debug("{0}: OUT {1}".format(initial,char.replace("\n", "\\n")))
-		sys.stdout.write(char)
+		self.output.write(char)
+		self.outputBytes += 1
 		self.advance()
 	def opcodeIn(self):
 		"""read a character from the terminal and write its ascii code to <a>. syntax: 20 a"""
-		ch = sys.stdin.read(1)
-
-		if ch == "!":
+		ch = self.input.read(1)
+
+		if ch is None:
+			# the input has nothing yet; stop without consuming the instruction so run() can be resumed
+			self.waiting = True
+			self.running = False
+		elif ch == "":
+			bump.debug("{0}: IN (end of input, halting)".format(self.position))
+			self.running = False
+		elif ch == "!":
 			bump.debug("WARNING: BECOMING SELF-AWARE")
 			self.aware()
 		else:
@@ -433,102 +660,370 @@ class Vm:
 
 			bump.debug("{0}: IN :{1}".format(initial, register_index))
 
-			self.registers[register_index].set(self.p(ord(ch)))
+			value = ord(ch)
+			self.registers[register_index] = value
+			if(bump.debugFlag):
+				bump.register(register_index, value)
 	def opcodeNoop(self):
 		bump.debug("{0}: NOOP".format(self.position))
 		self.advance()
 
 	def aware(self):
-		# munch the rest of the line from stdin and see if it's a recognised command
-		line = sys.stdin.readline()
+		# munch the rest of the line from input and see if it's a recognised command
+		line = self.input.readline()
 		w = line.split(' ')
 		fw = w[0].strip()
-		print fw
+		print >>self.output, fw
 		if fw == "save":
 			filename = "";
 			try:
 				filename = w[1].strip()
 			except Exception, e:
 				filename = "001"
-			print ">>> Save to: " + filename + "\n"
-			memfilename = filename + ".mem"
-			f = open(filename, 'w')
-			f2 = open(memfilename, 'w')
-			f.write(str(self.position) + "\n")
-			for reg in self.registers:
-				f.write(str(self.u(reg.get())) + "\n")
-			for i in self.stack:
-				f.write(str(self.u(i)) + "\n");
-			for m in self.memory.dump():
-				f2.write(m)
-			f.close()
-			f2.close()
+			print >>self.output, ">>> Save to: " + filename + "\n"
+			self.saveState(filename)
 		elif fw == "load":
 			filename = "";
 			try:
 				filename = w[1].strip()
 			except Exception, e:
 				filename = "001"
-			print ">>> Load from: " + filename + "\n"
-			memfilename = filename + ".mem"
-			f = open(filename, 'r')
-			position_str = f.readline()
-			self.position = int(position_str)
-			for reg_n in xrange(0,7):
-				self.registers[reg_n].set(self.p(int(f.readline())))
-			self.stack = []
-			for line in f:
-				self.stack.append(self.p(int(line)))
-			self.loadFile(memfilename)
-			f.close()
+			print >>self.output, ">>> Load from: " + filename + "\n"
+			self.loadState(filename)
 		elif fw == "setreg":
 			# do another thing
 			reg_n = int(w[1].strip())
 
-			reg_data = self.p(int(w[2].strip()))
-			print r">>> Setting Register {0} to {1}".format(reg_n, reg_data)
-			self.registers[reg_n].set(reg_data)
+			reg_data = int(w[2].strip())
+			print >>self.output, r">>> Setting Register {0} to {1}".format(reg_n, reg_data)
+			self.registers[reg_n] = reg_data
+			if(bump.debugFlag):
+				bump.register(reg_n, reg_data)
 		elif fw == "barfreg":
 			i = 0
 			for reg in self.registers:
-				print r">>> Register {0} contains {1}".format(i, self.u(reg.get()))
+				print >>self.output, r">>> Register {0} contains {1}".format(i, reg)
 				i += 1
 		elif fw == "barfstack":
 			i = 0
-			for item in self.stack:
-				print r">>> Stack @{0} contains {1}".format(i, self.u(item))
+			for item in self.stack.dump():
+				print >>self.output, r">>> Stack @{0} contains {1}".format(i, item)
 				i += 1
+		elif fw == "stackstats":
+			if len(w) > 1:
+				limit = w[1].strip()
+				if limit == "off":
+					self.stack.maxDepth = None
+				else:
+					self.stack.maxDepth = int(limit)
+			print >>self.output, r">>> Stack depth: {0}".format(self.stack.size())
+			print >>self.output, r">>> Stack high-water mark: {0}".format(self.stack.highWater)
+			print >>self.output, r">>> Stack limit: {0}".format(self.stack.maxDepth if self.stack.maxDepth is not None else "none")
+			print >>self.output, r">>> Stack pushes/pops: {0}/{1}".format(self.stack.pushes, self.stack.pops)
+			print >>self.output, r">>> Stack memory: {0} bytes".format(self.stack.bytes())
 		elif fw == "logging":
-			print ">>> Logging!"
+			print >>self.output, ">>> Logging!"
 			if w[1].strip() == "on":
-				print ">>> Logging: ON"
+				print >>self.output, ">>> Logging: ON"
 				bump.flag(True)
 			elif w[1].strip() == "off":
-				print ">>> Logging: OFF"
+				print >>self.output, ">>> Logging: OFF"
 				bump.flag(False)
+		elif fw == "heatmap":
+			# heatmap on [window] | off | reset | snapshot [name]
+			action = "snapshot"
+			if len(w) > 1:
+				action = w[1].strip()
+			traced = isinstance(self.memory, TracedMemory)
+			if action == "on":
+				if not traced:
+					memory = TracedMemory()
+					if len(w) > 2:
+						memory.window = int(w[2].strip())
+					memory.load(self.memory.dump())
+					self.memory = memory
+				print >>self.output, ">>> Heatmap: ON"
+			elif action == "off":
+				if traced:
+					memory = Memory()
+					memory.load(self.memory.dump())
+					self.memory = memory
+				print >>self.output, ">>> Heatmap: OFF"
+			elif not traced:
+				print >>self.output, ">>> Heatmap is off; use !heatmap on"
+			elif action == "reset":
+				self.memory.reset()
+				print >>self.output, ">>> Heatmap counters reset"
+			elif action == "snapshot":
+				name = "heatmap"
+				if len(w) > 2:
+					name = w[2].strip()
+				for filename in self.memory.snapshot(name):
+					print >>self.output, ">>> Wrote " + filename
+		elif fw == "stats":
+			if self.metrics is None:
+				self.metrics = Metrics(self)
+			# wall-clock figures go straight to the terminal, not self.output, so recorded sessions still replay
+			for name, description, value in self.metrics.sample():
+				print >>sys.stderr, r">>> {0}: {1}".format(description, value)
+		elif fw == "metrics":
+			port = 9100
+			if len(w) > 1:
+				port = int(w[1].strip())
+			if self.metrics is None:
+				self.metrics = Metrics(self)
+			self.metrics.serve(port)
+			print >>self.output, r">>> Serving metrics on http://127.0.0.1:{0}/metrics".format(port)
 		else:
-			print ">>> Unrecognised command."
+			print >>self.output, ">>> Unrecognised command."
+
+class Metrics:
+	"""samples a Vm's counters. Rates are per second since the same consumer's previous sample
+	(or since the VM started, for its first), so sampling costs nothing while the VM runs; the VM
+	only bumps integer counters. Each consumer (!stats, the HTTP scraper) keeps its own window."""
+	def __init__(self, vm):
+		self.vm = vm
+		self.windows = {}
+		self.lock = threading.Lock()
+		self.server = None
+
+	def sample(self, consumer="stats"):
+		vm = self.vm
+		with self.lock:
+			now = time.time()
+			executed, writes, outputBytes = vm.executed, vm.memoryWrites, vm.outputBytes
+			then, lastExecuted, lastWrites = self.windows.get(consumer, (vm.started, 0, 0))
+			self.windows[consumer] = (now, executed, writes)
+		elapsed = max(now - then, 1e-9)
+		return [
+			("synacor_instructions_total", "Instructions executed", executed),
+			("synacor_instructions_per_second", "Instructions/sec", int((executed - lastExecuted) / elapsed)),
+			("synacor_position", "Current PC", vm.position),
+			("synacor_stack_depth", "Call depth", vm.stack.size()),
+			("synacor_memory_writes_total", "Memory writes", writes),
+			("synacor_memory_writes_per_second", "Memory writes/sec", int((writes - lastWrites) / elapsed)),
+			("synacor_output_bytes_total", "Output bytes", outputBytes),
+			("synacor_uptime_seconds", "Uptime (s)", int(now - vm.started)),
+		]
+
+	def prometheus(self):
+		lines = []
+		for name, description, value in self.sample("scrape"):
+			if name.endswith("_total"):
+				kind = "counter"
+			else:
+				kind = "gauge"
+			lines.append("# HELP {0} {1}".format(name, description))
+			lines.append("# TYPE {0} {1}".format(name, kind))
+			lines.append("{0} {1}".format(name, value))
+		return "\n".join(lines) + "\n"
+
+	def serve(self, port):
+		"""serves prometheus() on 127.0.0.1:port from a daemon thread."""
+		if self.server is not None:
+			return
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", port), MetricsHandler)
+		self.server.metrics = self
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path != "/metrics":
+			self.send_error(404)
+			return
+		body = self.server.metrics.prometheus()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class Session:
+	"""stands in for a Vm's input and output, one line of input at a time.
+
+	Each line handed to the VM is preceded by a checkpoint: a rolling crc32 of
+	everything output so far and the VM's stateHash(). A session log is a header
+	followed by one "<output hash> <state hash> <escaped line>" entry per
+	checkpoint; the final entry has an empty line, meaning end of input."""
+	header = "synacor-session 1"
+
+	def __init__(self, vm):
+		self.vm = vm
+		self.outhash = 0
+		self.buffer = ""
+		self.checkpoints = 0
+		vm.input = self
+		vm.output = self
+
+	def write(self, data):
+		self.outhash = zlib.crc32(data, self.outhash)
+
+	def read(self, size=1):
+		if not self.buffer:
+			line = self.nextLine()
+			if line is None:
+				return None
+			self.buffer = line
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+	def readline(self):
+		if not self.buffer:
+			line = self.nextLine()
+			if line is None:
+				return ""
+			self.buffer = line
+		data, self.buffer = self.buffer, ""
+		return data
+
+	def checkpoint(self):
+		self.checkpoints += 1
+		return (self.outhash & 0xffffffff, self.vm.stateHash())
+
+class Recorder(Session):
+	"""passes input from source through to the VM, logging every line with its checkpoint."""
+	def __init__(self, vm, source, log):
+		Session.__init__(self, vm)
+		self.source = source
+		self.sink = sys.stdout
+		self.log = log
+		self.finished = False
+		self.log.write(Session.header + "\n")
+
+	def write(self, data):
+		Session.write(self, data)
+		self.sink.write(data)
+
+	def nextLine(self):
+		if self.finished:
+			return ""
+		outhash, state = self.checkpoint()
+		line = self.source.readline()
+		self.log.write("{0:08x} {1:08x} {2}\n".format(outhash, state, line.encode('string_escape')))
+		self.log.flush()
+		if line == "":
+			self.finished = True
+		return line
+
+class Script(Session):
+	"""feeds a list of input lines to the VM with no terminal I/O, keeping everything it prints.
+
+	once the lines run out the VM sees end of input and halts, or, with wait set, run() returns
+	Vm.WAITING and carries on after feed() supplies more."""
+	def __init__(self, vm, lines, wait=False):
+		Session.__init__(self, vm)
+		self.lines = list(lines)
+		self.wait = wait
+		self.transcript = []
+
+	def feed(self, lines):
+		self.lines.extend(lines)
+
+	def write(self, data):
+		Session.write(self, data)
+		self.transcript.append(data)
+
+	def nextLine(self):
+		if not self.lines:
+			if self.wait:
+				return None
+			return ""
+		return self.lines.pop(0) + "\n"
+
+	def text(self):
+		"""everything printed so far, without the NUL high bytes opcodeOut writes."""
+		return "".join(self.transcript).replace("\0", "")
+
+class Replayer(Session):
+	"""feeds a recorded session back to the VM with no terminal I/O, stopping at the first checkpoint that differs."""
+	def __init__(self, vm, log):
+		Session.__init__(self, vm)
+		if log.readline().strip() != Session.header:
+			raise ValueError("not a session log")
+		self.entries = [entry.rstrip("\n").split(" ", 2) for entry in log]
+		self.divergence = None
+
+	def nextLine(self):
+		if self.divergence is not None or self.checkpoints >= len(self.entries):
+			return ""
+		outhash, state = self.checkpoint()
+		expected = self.entries[self.checkpoints - 1]
+		if int(expected[0], 16) != outhash or int(expected[1], 16) != state:
+			previous = ""
+			if self.checkpoints > 1:
+				previous = self.entries[self.checkpoints - 2][2]
+			self.divergence = "checkpoint {0} (after input '{1}'): expected output/state {2}/{3}, got {4:08x}/{5:08x}".format(self.checkpoints, previous, expected[0], expected[1], outhash, state)
+			self.vm.running = False
+			return ""
+		return expected[2].decode('string_escape')
+
+	def report(self):
+		if self.divergence is not None:
+			return "replay diverged at " + self.divergence
+		if self.checkpoints < len(self.entries):
+			return "replay diverged: program stopped after {0} of {1} checkpoints".format(self.checkpoints, len(self.entries))
+		return "replay ok: {0} checkpoints matched".format(self.checkpoints)
+
+	def ok(self):
+		return self.divergence is None and self.checkpoints == len(self.entries)
 
 class Bump:
 	def __init__(self, filename, vm, initialFlag):
 		self.vm = vm
 		self.debugFlag = initialFlag
-		self.dest = open(filename, 'w')
+		self.dest = None
+		if filename is not None:
+			self.dest = open(filename, 'w')
 
 	def debug(self, string):
 		# log string if self.debug is true
 		if(self.debugFlag):
 			logging.debug(string)
 
+	def register(self, index, value):
+		# log a register write; callers check debugFlag first so nothing is formatted or called when logging is off
+		logging.debug(r":{0} <-- {1}".format(index, value))
+
 	def flag(self, onIfTrue):
 		self.debugFlag = onIfTrue
 
 
-vm = Vm()
+# importers get a Bump with no log file; running vm.py replaces it with one writing challenge.log
+bump = Bump(None, None, False)
+
+if __name__ == "__main__":
+	# python vm.py stacklimit <depth> [...] caps the stack from the start, like !stackstats <depth>
+	args = sys.argv[1:]
+	maxStackDepth = None
+	if len(args) > 1 and args[0] == "stacklimit":
+		maxStackDepth = int(args[1])
+		args = args[2:]
+	vm = Vm(maxStackDepth)
+
+	logging.basicConfig(filename='challenge.log', level=logging.DEBUG)
+
+	bump = Bump("challenge.log", vm, False)
+
+	vm.loadFile("challenge.bin")
 
-logging.basicConfig(filename='challenge.log', level=logging.DEBUG)
+	# python vm.py record <session log> / python vm.py replay <session log>
+	mode = ""
+	if len(args) > 1:
+		mode = args[0]
+	if mode == "record":
+		session = Recorder(vm, sys.stdin, open(args[1], 'w'))
+	elif mode == "replay":
+		session = Replayer(vm, open(args[1], 'r'))
 
-bump = Bump("challenge.log", vm, False)
+	status = vm.run()
+	if status == Vm.ERROR:
+		sys.stderr.write(">>> {0}, halting.\n".format(vm.error))
 
-vm.loadFile("challenge.bin")
-vm.run()
+	if mode == "replay":
+		sys.stderr.write(session.report() + "\n")
+		sys.exit(0 if session.ok() else 1)